@@ -1,8 +1,26 @@
 import os
 import datetime
+import math
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import requests_cache
+except ImportError:
+    requests_cache = None
+
+# orjson is the only optional JSON fast path, every API response
+# is decoded through parse_json, which falls back to stdlib json
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 # report components
@@ -16,39 +34,150 @@ TOTAL_COMPLETED_TASKS = "\n## Completed tasks ({comp_total}):\n"
 TODOS_URL = "https://json.medrocket.ru/todos"
 USERS_URL = "https://json.medrocket.ru/users"
 
-def get_users() -> list:
-    """Gets page with user objects on demand"""
+REQUEST_TIMEOUT = 10
+PAGE_LIMIT = 10000 # big enough to get every object in one page
+MAX_WORKERS = 16 # concurrent page requests per endpoint
+
+# if requests-cache is installed, responses are stored in user's cache
+# directory, away from reports, and revalidated via ETag/Last-Modified
+# once they expire
+CACHE_NAME = "report_builder_http_cache"
+CACHE_EXPIRE_AFTER = 300 # seconds
+
+# shared session, keeps connections to the API alive between requests,
+# it is created on first use, so importing this module has no side effects
+SESSION = None
+SESSION_LOCK = threading.Lock()
+
+# replacements for characters that are not allowed in filenames
+SAFE_FILENAME = str.maketrans({
+    "/": "(f_slash)",
+    "\\": "(b_slash)",
+    ":": "(colon)",
+    "*": "(star)",
+    "?": "(q)",
+    '"': "(dq)",
+    "<": "(lt)",
+    ">": "(gt)",
+    "|": "(pipe)",
+})
+
+# regex pattern, compiled once per program run
+DATE_RE = re.compile(
+    "(?P<day>[0-9]{2}).(?P<month>[0-9]{2}).(?P<year>[0-9]{4})"
+    " (?P<hour>[0-9][0-9]):(?P<minute>[0-9][0-9])")
+
+def get_session() -> requests.Session:
+    """Gets shared session, creates it on the first call"""
+
+    global SESSION
+
+    with SESSION_LOCK:
+        if SESSION is None:
+            if requests_cache is not None:
+                session = requests_cache.CachedSession(
+                    CACHE_NAME,
+                    backend="sqlite",
+                    use_cache_dir=True,
+                    expire_after=CACHE_EXPIRE_AFTER,
+                    cache_control=True,)
+            else:
+                session = requests.Session()
 
-    page_num = 1
+            # users and todos are fetched at the same time, each with up to
+            # MAX_WORKERS concurrent page requests, pool has room for all of them
+            session.mount("https://", HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=2 * MAX_WORKERS,
+                max_retries=Retry(total=3, backoff_factor=0.5,
+                                  status_forcelist=(500, 502, 503, 504)),))
+            SESSION = session
 
-    while(True):
-        page = requests.get(USERS_URL, params={"_page":page_num})
+    return SESSION
 
-        if(page.status_code != 200):
-            page.raise_for_status()
+def parse_json(response: requests.Response):
+    """Parses JSON body of *response*.
 
-        if(page.json() == []):
-            break
+    Every API response goes through this function, body is decoded
+    with orjson if it is installed, otherwise with Response.json()
+    """
 
-        page_num += 1
-        yield page.json()
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
 
-def get_todos(user_id: int) -> list: 
-    """Gets page with todo objects on demand"""
+def get_page(url: str, page_num: int, limit: int) -> tuple:
+    """Gets page *page_num* of objects from *url*.
 
-    page_num = 1
+    Returns list of objects and total number of objects reported
+    by server, if server doesn't report it - None instead of total
+    """
+
+    response = get_session().get(url,
+                                 params={"_page":page_num, "_limit":limit},
+                                 timeout=REQUEST_TIMEOUT)
 
-    while(True):
-        page = requests.get(TODOS_URL, params={"userId":user_id, "_page":page_num})
+    response.raise_for_status()
 
-        if(page.status_code != 200):
-            page.raise_for_status()
+    objects = parse_json(response)
+    total = response.headers.get("X-Total-Count")
 
-        if(page.json() == []):
-            break
+    return objects, int(total) if total is not None else None
 
+def get_all(url: str) -> list:
+    """Gets every object from *url*.
+
+    Asks for all objects in a single page first, if server caps
+    page size (or doesn't report total number of objects), the
+    remaining pages are fetched as well
+    """
+
+    objects, total = get_page(url, 1, PAGE_LIMIT)
+    page_size = len(objects)
+
+    if page_size == 0:
+        return objects
+
+    # server reports total - remaining pages are fetched concurrently
+    if total is not None:
+        if total <= page_size:
+            return objects
+        pages = range(2, math.ceil(total / page_size) + 1)
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for page in executor.map(
+                    lambda page_num: get_page(url, page_num, page_size)[0],
+                    pages):
+                objects.extend(page)
+        return objects
+
+    # no total - first page could have been capped by server to less
+    # than PAGE_LIMIT, so pages of the size server returned are fetched
+    # one by one until a page comes back empty or short
+    page = objects
+    page_num = 1
+    while len(page) == page_size:
         page_num += 1
-        yield page.json()
+        page, _ = get_page(url, page_num, page_size)
+        objects.extend(page)
+
+    return objects
+
+def get_users() -> list:
+    """Gets all user objects"""
+
+    return get_all(USERS_URL)
+
+def get_todos() -> dict: 
+    """Gets todo objects of every user.
+
+    Returns dict that maps user id to the list of user's todos
+    """
+
+    todos_by_user = {}
+    for todo in get_all(TODOS_URL):
+        todos_by_user.setdefault(todo.get("userId"), []).append(todo)
+
+    return todos_by_user
 
 
 # 1. Finds date in report file via regex
@@ -56,14 +185,11 @@ def get_todos(user_id: int) -> list:
 def get_date(path: str) -> str:
     """Gets creation date from report file"""
 
-    re_exp = ("(?P<day>[0-9]{2}).(?P<month>[0-9]{2}).(?P<year>[0-9]{4})" 
-              " (?P<hour>[0-9][0-9]):(?P<minute>[0-9][0-9])")
-
     date_format = "{year}-{month}-{day}T{hour}:{minute}" # THIS LINE
 
     with open(path, "r", encoding="utf-8") as file:
         data = file.read()
-        match = re.search(re_exp, data)
+        match = DATE_RE.search(data)
         if match:
             return date_format.format(
                 year=match.group("year"),
@@ -75,199 +201,188 @@ def get_date(path: str) -> str:
         return 0
 
 
-def validate_user(user: dict) -> bool:
-    """Checks if user object has all required fields"""
+def extract_user(user: dict) -> Optional[tuple]:
+    """Gets required fields from user object.
 
-    try:
-        company = user["company"]["name"]
-        fullname = user["name"]
-        email = user["email"]
-    except KeyError:
-        print("User object is malformed")
-        return False
-    return True
-
-def validate_todo(todo: dict) -> bool: 
-    """Checks if todo object has all required fields"""
-
-    try:
-        title = todo["title"]
-        completed = todo["completed"]
-    except KeyError:
-        print("ToDo object is malformed")
-        return False
+    Returns tuple of company name, full name and email,
+    if any of them is missing - returns None
+    """
 
-    return True
+    company = user.get("company") or {}
+    info = (company.get("name"), user.get("name"), user.get("email"))
+    if None in info:
+        print("User object is malformed")
+        return None
+    return info
 
-# opens file right after its creation and compares to previously formatted report
-def validate_file(file_path: str, report: str):  
-    """Validates if report was written successfully.
+def extract_todo(todo: dict) -> Optional[tuple]: 
+    """Gets required fields from todo object.
 
-    If file write of report was successful returns True, otherwise returns False
-    If there is no such file - return None
+    Returns tuple of title and completion status,
+    if any of them is missing - returns None
     """
 
-    if os.path.isfile(file_path):
-        with open(file_path, "r", encoding="utf-8") as file:
-            report_file = file.read()
-            return report_file == report
-
-    return None
+    info = (todo.get("title"), todo.get("completed"))
+    if None in info:
+        print("ToDo object is malformed")
+        return None
+    return info
 
 # puts every user's tasks in report components with required formatting
 # if there is no tasks for user returns None
-def create_report(user: dict) -> str:
+def create_report(user_info: tuple, todos: list, time: str) -> Optional[str]:
     """Creates report string.
 
-    Puts every data field from user and user's todos 
-    into predefined templates
+    Puts every data field from *user_info* (see extract_user) and 
+    user's *todos* into predefined templates, *time* is report's
+    creation time
     """
 
-    company = user["company"]["name"]
-    fullname = user["name"]
-    email = user["email"]
+    company, fullname, email = user_info
 
-    time = datetime.datetime.now().strftime("%d.%m.%Y %H:%M")
+    # malformed todos are skipped
+    tasks = [info for info in map(extract_todo, todos) if info is not None]
 
-    cur_tasks = ""
-    comp_tasks = ""
-
-    cur_total = 0
-    comp_total = 0
-    
-    for page in get_todos(user["id"]):
-        for task in page:
-            if validate_todo(task):
-                if len(task["title"])>46:
-                        task["title"] = task["title"][:46] + "..."
-                if task["completed"] == False:
-                    cur_tasks += "- " + task["title"] + "\n"
-                    cur_total += 1
-                elif task["completed"] == True:
-                    comp_tasks += "- " + task["title"] + "\n"
-                    comp_total += 1
+    # titles up to 49 characters would not get shorter with "..."
+    lines = [
+        (f"- {title if len(title) <= 49 else title[:46] + '...'}\n", completed)
+        for title, completed in tasks
+    ]
+    cur_parts = [line for line, completed in lines if not completed]
+    comp_parts = [line for line, completed in lines if completed]
 
+    cur_total, comp_total = len(cur_parts), len(comp_parts)
     total_tasks = cur_total + comp_total
 
-    report = (
-        HEADER.format(company=company, fullname=fullname, email=email, time=time)
-        + TOTAL_TASKS.format(total_tasks=total_tasks)
-        + TOTAL_CURRENT_TASKS.format(cur_total=cur_total)
-        + cur_tasks
-        + TOTAL_COMPLETED_TASKS.format(comp_total=comp_total)
-        + comp_tasks
-        ) 
-    
     if total_tasks == 0:
         return None
 
+    report = "".join([
+        HEADER.format(company=company, fullname=fullname, email=email, time=time),
+        TOTAL_TASKS.format(total_tasks=total_tasks),
+        TOTAL_CURRENT_TASKS.format(cur_total=cur_total),
+        *cur_parts,
+        TOTAL_COMPLETED_TASKS.format(comp_total=comp_total),
+        *comp_parts,
+        ]) 
+
     return report 
 
 
-def create_filename(username: str, *, date: str = None) -> str:
+def create_filename(username: str, *, date: Optional[str] = None) -> str:
     """Creates filename for *username*'s report """
 
-    if date == None:
+    if date is None:
         return f"{username}.txt"
     return f"old_{username}_{date}.txt"
 
 
-def save_report(report: str, username: str) -> None:
+def save_report(report: str, username: str, existing: set) -> None:
     """Saves report to a file if no issues occured.
 
-    If current report is malformed, this function deletes it,
-    finds the most recent report file and reassigns its name
-    to be the relevant one, if no recent report files are found 
-    just delete the malformed one
-    """
-
-    report_path = "tasks/" + create_filename(username)
-
-    # check if file already exists
-    # if exists - rename it 
-    if os.path.isfile(report_path):
-        date = get_date(report_path)
-        new_path = "tasks/" + create_filename(username, date=date)
-        os.rename(report_path, new_path)
-    
-    try:
-        with open(report_path, "w", encoding="utf-8") as rep_file:
-            rep_file.write(report)   
-    except Exception:
-        print(f"Error occured while writing to file {report_path}")
-    finally:
-        file_is_valid = validate_file(report_path, report)
-        if file_is_valid != True: 
-            if file_is_valid == False:
-                os.remove(report_path) 
-            last_report = get_last_report(username)
-            if last_report != None:                    
-                os.rename("tasks/"+last_report, report_path) 
-
-
-def get_last_report(username: str) -> str: #change uA789 after completion
-    """Gets the last report's filename for *username*, if report exists.
-
-    If there is a report for *username* that has been created recently, 
-    this function gets its filename and returns it. If there is no previously
-    created reports for that *username* - return None.
+    Report is written to a temporary file first, which replaces
+    the current report only after a successful write, so the
+    current report is never left malformed.
+    *existing* is a set of filenames in tasks directory, it is used
+    as a hint instead of checking the disk and updated after report
+    is saved. If report can't be saved, error is printed, previous
+    report is restored and the temporary file is removed
     """
 
-    file_names = os.listdir("tasks/")
-
-    re_exp = (f"old_{username}_(?P<year>[0-9]{{4}})-"
-    "(?P<month>[0-9]{2})-(?P<day>[0-9]{2})"
-    "T(?P<hour>[0-9]{2}):(?P<minute>[0-9]{2}).txt")
+    filename = create_filename(username)
+    report_path = "tasks/" + filename
+    tmp_path = report_path + ".tmp"
 
-    today = datetime.datetime.now()
-    min_dif = None
-    last_report = None
+    # report is encoded only once, "\n" is converted to os.linesep
+    # the same way text mode open() would do it
+    data = report.replace("\n", os.linesep).encode("utf-8")
 
-    for file_name in file_names:
-        match = re.match(re_exp, file_name)
+    # raw file descriptor, no buffered/text IO objects for one write
+    # O_BINARY keeps Windows from translating line endings again
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
 
-        if match:
-            year = int( match.group("year"))
-            month = int( match.group("month"))
-            day = int( match.group("day"))
-            hour = int( match.group("hour"))
-            minute = int( match.group("minute"))
-
-            file_date = datetime.datetime(
-                year=year, 
-                month=month, 
-                day=day, 
-                hour=hour, 
-                minute=minute,)
+    replaced = False
+    try:
+        # 0o666 as with open(), so umask decides resulting permissions
+        fd = os.open(tmp_path, flags, 0o666)
+        try:
+            view = memoryview(data)
+            while view: # os.write may write only part of data
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+
+        # if file already exists - rename it, *existing* is only a hint,
+        # file could have been removed after tasks directory was scanned
+        old_path = None
+        if filename in existing:
+            try:
+                date = get_date(report_path)
+                old_path = "tasks/" + create_filename(username, date=date)
+                os.rename(report_path, old_path)
+            except FileNotFoundError:
+                old_path = None
+                existing.discard(filename)
+
+        try:
+            os.replace(tmp_path, report_path)
+        except OSError:
+            # current report was already renamed - give its name back,
+            # if that fails too, user is left without current report
+            if old_path is not None:
+                try:
+                    os.rename(old_path, report_path)
+                except OSError:
+                    existing.add(os.path.basename(old_path))
+                    existing.discard(filename)
+            raise
+
+        if old_path is not None:
+            existing.add(os.path.basename(old_path))
+        replaced = True
+    except OSError as e:
+        print(f"Error occured while saving file {report_path}: {e}")
+    finally:
+        # temporary file is never left behind if report wasn't saved
+        if not replaced:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
 
-            diff = today - file_date
+    if replaced:
+        existing.add(filename)
 
-            if(min_dif == None):
-                min_dif = diff
-                last_report = file_name
 
-            if(diff < min_dif):
-                min_dif = diff
-                last_report = file_name
-    
-    return last_report
+if __name__ == "__main__":
 
+    dir = os.path.join(os.curdir, "tasks")
+    os.makedirs(dir, exist_ok=True)
 
+    # snapshot of tasks directory, so saving doesn't stat every report
+    with os.scandir(dir) as entries:
+        existing = {entry.name for entry in entries}
 
-if __name__ == "__main__":
+    # every report of this run shares the same creation time
+    time = datetime.datetime.now().strftime("%d.%m.%Y %H:%M")
 
-    dir = os.path.join(os.curdir, "tasks")
-    if not os.path.exists(dir):
-        os.makedirs(dir)
-
-    for page in get_users():
-        for user in page:
-            if not validate_user(user):
-                print(user["username"], " doesn't have required")
-                continue 
-            report = create_report(user)
-            if report == None:
-                print(user["username"], " doesn't have todos")
-            else:
-                username = user["username"].replace("/", "(f_slash)")
-                save_report(report, username)
\ No newline at end of file
+    # users and todos are requested at the same time
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        users_future = executor.submit(get_users)
+        todos_future = executor.submit(get_todos)
+
+    users = users_future.result()
+    todos_by_user = todos_future.result()
+
+    for user in users:
+        user_info = extract_user(user)
+        if user_info is None:
+            print(user["username"], " doesn't have required")
+            continue 
+        todos = todos_by_user.get(user["id"], [])
+        report = create_report(user_info, todos, time)
+        if report is None:
+            print(user["username"], " doesn't have todos")
+        else:
+            username = user["username"].translate(SAFE_FILENAME)
+            save_report(report, username, existing)
\ No newline at end of file